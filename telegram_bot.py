@@ -1,17 +1,31 @@
 import os
+import io
+import re
 import json
 import base64
+import asyncio
+import hashlib
+import functools
 import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI
 import gspread
+from PIL import Image, ImageStat
 from google.oauth2.service_account import Credentials
 
-from telegram import Update
+from telegram import Message, Update
 from telegram.constants import ChatAction
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     MessageHandler,
     ContextTypes,
@@ -39,6 +53,48 @@ GOOGLE_SERVICE_ACCOUNT_JSON_B64 = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON_B64")
 
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
+# Optional webhook mode; without WEBHOOK_URL the bot falls back to long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "100"))
+PORT = int(os.getenv("PORT", "8080"))
+
+# Bump whenever the extraction prompt or the expected JSON shape changes,
+# so cached extractions from older prompts are not reused.
+PROMPT_VERSION = "3"
+SCHEMA_VERSION = "3"
+
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "/data/llm_cache.sqlite")
+LLM_CACHE_MEMORY_SIZE = int(os.getenv("LLM_CACHE_MEMORY_SIZE", "512"))
+LLM_CACHE_TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS", "30"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "5"))
+EXTRACTION_MAX_RETRIES = 2
+# extra time the Sheets writer waits to gather more invoices into one append
+SHEETS_BATCH_WINDOW = float(os.getenv("SHEETS_BATCH_WINDOW", "0"))
+# opt-in: photos of one album arriving within this many seconds of each other are
+# read as pages of a single invoice in one vision call. Off (0) by default, since an
+# album is also how users bulk-send separate receipts, each of which needs its own row.
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "0"))
+
+# Local pre-checks that reject unusable photos before paying for a vision call.
+# IMAGE_MIN_SIDE applies to the longest side: Telegram caps photos at 1280 px, so
+# long thermal receipts have a short side well under 400.
+# A bright image is only rejected when it is also flat (washed out), since clean
+# screenshots of digital invoices are mostly white.
+IMAGE_MIN_SIDE = int(os.getenv("IMAGE_MIN_SIDE", "400"))
+IMAGE_MIN_BRIGHTNESS = float(os.getenv("IMAGE_MIN_BRIGHTNESS", "20"))
+IMAGE_MAX_BRIGHTNESS = float(os.getenv("IMAGE_MAX_BRIGHTNESS", "235"))
+IMAGE_MIN_CONTRAST = float(os.getenv("IMAGE_MIN_CONTRAST", "10"))
+
+# Photos larger than this longest side are shrunk before upload. Telegram photos are
+# at most 1280 px, so by default they go through untouched and the model's own
+# high-detail scaling keeps the small print; only oversized images are re-encoded.
+# "high" detail is needed to read per-line qty/rate/VAT; "low" shows the model a
+# 512 px thumbnail, so it is opt-in and re-read at "high" if no items come back.
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1536"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "80"))
+OPENAI_IMAGE_DETAIL = os.getenv("OPENAI_IMAGE_DETAIL", "high")
+
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN not set")
 if not OPENAI_API_KEY:
@@ -47,43 +103,119 @@ if not GOOGLE_SHEET_ID:
     raise ValueError("GOOGLE_SHEET_ID not set")
 if not (GOOGLE_SERVICE_ACCOUNT_JSON or GOOGLE_SERVICE_ACCOUNT_JSON_B64):
     raise ValueError("GOOGLE_SERVICE_ACCOUNT_JSON or GOOGLE_SERVICE_ACCOUNT_JSON_B64 not set")
-
-client = OpenAI(api_key=OPENAI_API_KEY)
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("TG_WEBHOOK_SECRET not set (required when WEBHOOK_URL is set)")
+
+# one long-lived pool so consecutive invoices reuse the TLS connection to OpenAI
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+# cap how many vision requests are in flight at once
+openai_slots = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
 
 SHEET1_NAME = "invoices"         # دقیقا مثل تب شیت شما
 SHEET2_NAME = "Detailed_Items"   # دقیقا مثل تب شیت شما
 
+SUB_CATEGORIES = (
+    "Gas",
+    "Grocery",
+    "Restaurant",
+    "Office Supplies",
+    "Utilities",
+    "Transport",
+    "Maintenance",
+    "Other",
+)
+_ALLOWED_SUBCAT = frozenset(SUB_CATEGORIES)
+
 # ----------------------------
 # Google Sheets (NO creation)
 # ----------------------------
+# The authorized client, spreadsheet and worksheet handles are built once per
+# process and reused; only a 401 from the API forces a rebuild.
+_sheets_lock = threading.Lock()
+_spreadsheet = None
+_worksheets: Dict[str, Any] = {}
+
+# gspread is blocking HTTP; its calls run on a small dedicated pool so they
+# cannot starve the default executor used for image work and the cache
+_sheets_pool = ThreadPoolExecutor(max_workers=5, thread_name_prefix="sheets")
+
+async def run_sheets_call(fn, *args) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_sheets_pool, fn, *args)
+
+@functools.lru_cache(maxsize=1)
 def _load_service_account_info() -> Dict[str, Any]:
     if GOOGLE_SERVICE_ACCOUNT_JSON:
         return json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-    decoded = base64.b64decode(GOOGLE_SERVICE_ACCOUNT_JSON_B64).decode("utf-8")
-    return json.loads(decoded)
+    # json.loads detects UTF-8 bytes itself, no need for an intermediate str
+    return json.loads(base64.b64decode(GOOGLE_SERVICE_ACCOUNT_JSON_B64))
 
 def get_spreadsheet():
-    scopes = [
-        "https://www.googleapis.com/auth/spreadsheets",
-        "https://www.googleapis.com/auth/drive",
-    ]
-    creds = Credentials.from_service_account_info(_load_service_account_info(), scopes=scopes)
-    gc = gspread.authorize(creds)
-    return gc.open_by_key(GOOGLE_SHEET_ID)
+    global _spreadsheet
+    with _sheets_lock:
+        if _spreadsheet is None:
+            scopes = [
+                "https://www.googleapis.com/auth/spreadsheets",
+                "https://www.googleapis.com/auth/drive",
+            ]
+            creds = Credentials.from_service_account_info(_load_service_account_info(), scopes=scopes)
+            gc = gspread.authorize(creds)
+            _spreadsheet = gc.open_by_key(GOOGLE_SHEET_ID)
+        return _spreadsheet
+
+def reset_spreadsheet() -> None:
+    global _spreadsheet
+    with _sheets_lock:
+        _spreadsheet = None
+        _worksheets.clear()
 
 def get_ws(sh, name: str):
-    return sh.worksheet(name)
+    with _sheets_lock:
+        if name not in _worksheets:
+            # one metadata fetch resolves every tab instead of one GET per name
+            _worksheets.update((ws.title, ws) for ws in sh.worksheets())
+        if name not in _worksheets:
+            raise gspread.exceptions.WorksheetNotFound(name)
+        return _worksheets[name]
+
+def prefetch_sheets() -> None:
+    sh = get_spreadsheet()
+    for name in (SHEET1_NAME, SHEET2_NAME):
+        get_ws(sh, name)
+
+def append_to_sheet(name: str, rows: List[List[Any]]) -> None:
+    for attempt in range(2):
+        ws = get_ws(get_spreadsheet(), name)
+        try:
+            ws.append_rows(rows, value_input_option="USER_ENTERED")
+            return
+        except gspread.exceptions.APIError as e:
+            if attempt or e.response.status_code != 401:
+                raise
+            logger.warning("Sheets API returned 401, re-authorizing")
+            reset_spreadsheet()
 
 # ----------------------------
 # Helpers
 # ----------------------------
-def clean_json_only(text: str) -> str:
-    text = (text or "").strip()
-    start = text.find("{")
-    end = text.rfind("}")
-    if start == -1 or end == -1 or end <= start:
-        raise ValueError("Model did not return valid JSON.")
-    return text[start:end + 1]
+# thousands separators and stray whitespace are dropped in one C-level pass;
+# the Arabic decimal separator becomes "."
+_NUMBER_TRANSLATION = str.maketrans({
+    ",": None,
+    " ": None,
+    "\t": None,
+    "\xa0": None,
+    "\u066c": None,
+    "\u066b": ".",
+})
+# only plain decimals reach float(); "null", "nan", "inf" and OCR noise are
+# rejected up front instead of via exception unwinding
+_NUMBER_RE = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
 
 def safe_str(x: Any) -> str:
     return str(x).strip() if x is not None else ""
@@ -93,14 +225,14 @@ def to_number(value: Any) -> Optional[float]:
         return None
     if isinstance(value, (int, float)):
         return float(value)
-    s = str(value).strip()
-    if not s or s.lower() in {"null", "none", "nan"}:
-        return None
-    s = s.replace(",", "")
-    try:
-        return float(s)
-    except Exception:
+    return _parse_number(str(value))
+
+@functools.lru_cache(maxsize=4096)
+def _parse_number(raw: str) -> Optional[float]:
+    s = raw.strip().translate(_NUMBER_TRANSLATION)
+    if not _NUMBER_RE.fullmatch(s):
         return None
+    return float(s)
 
 def vat_yes_no(vat_amount: Any) -> str:
     num = to_number(vat_amount)
@@ -108,24 +240,29 @@ def vat_yes_no(vat_amount: Any) -> str:
         return "No"
     return "Yes" if num > 0 else "No"
 
-def normalize_date_yyyy_mm_dd_slash(raw: Any) -> str:
-    s = str(raw).strip() if raw is not None else ""
-    if not s:
-        return datetime.now(timezone.utc).strftime("%Y/%m/%d")
-
-    fmts = [
-        "%Y-%m-%d",
-        "%Y/%m/%d",
-        "%d-%m-%Y",
-        "%d/%m/%Y",
-        "%d-%m-%y",
-        "%d/%m/%y",
-        "%d-%b-%y",
-        "%d-%b-%Y",
-        "%d %b %Y",
-        "%d %B %Y",
-    ]
-    for f in fmts:
+# year-first dates are by far the most common; parse them without strptime
+_YMD_RE = re.compile(r"^(\d{4})([-/])(\d{1,2})\2(\d{1,2})$")
+_DATE_FORMATS = (
+    "%d-%m-%Y",
+    "%d/%m/%Y",
+    "%d-%m-%y",
+    "%d/%m/%y",
+    "%d-%b-%y",
+    "%d-%b-%Y",
+    "%d %b %Y",
+    "%d %B %Y",
+)
+
+@functools.lru_cache(maxsize=1024)
+def _parse_date(s: str) -> Optional[str]:
+    m = _YMD_RE.match(s)
+    if m:
+        try:
+            return datetime(int(m.group(1)), int(m.group(3)), int(m.group(4))).strftime("%Y/%m/%d")
+        except ValueError:
+            return None
+
+    for f in _DATE_FORMATS:
         try:
             dt = datetime.strptime(s, f)
             return dt.strftime("%Y/%m/%d")
@@ -136,77 +273,283 @@ def normalize_date_yyyy_mm_dd_slash(raw: Any) -> str:
         dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
         return dt.strftime("%Y/%m/%d")
     except Exception:
-        return datetime.now(timezone.utc).strftime("%Y/%m/%d")
+        return None
+
+def normalize_date_yyyy_mm_dd_slash(raw: Any) -> str:
+    s = str(raw).strip() if raw is not None else ""
+    parsed = _parse_date(s) if s else None
+    # the "today" fallback stays outside the cache so it never goes stale
+    return parsed or datetime.now(timezone.utc).strftime("%Y/%m/%d")
 
 # ----------------------------
-# AI Extraction
+# Image Checks
 # ----------------------------
-def extract_with_ai(image_bytes: bytes) -> Dict[str, Any]:
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
-
-    prompt = """
-You are extracting structured data from a TAX INVOICE image.
-
-Return ONLY JSON in this exact schema:
-
-{
-  "date": "",
-  "supplier": "",
-  "net_total": "",
-  "vat_amount": null,
-  "sub_category": "",
-  "items": [
-    {
-      "name": "",
-      "qty": "",
-      "rate": "",
-      "discount": "",
-      "vat": "",
-      "line_total": ""
-    }
-  ]
-}
+def image_quality_problem(image_bytes: bytes) -> Optional[str]:
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        if max(img.size) < IMAGE_MIN_SIDE:
+            return "too_small"
+        gray = img.convert("L")
+
+    stat = ImageStat.Stat(gray)
+    brightness = stat.mean[0]
+    if brightness < IMAGE_MIN_BRIGHTNESS:
+        return "too_dark"
+    if brightness > IMAGE_MAX_BRIGHTNESS and stat.stddev[0] < IMAGE_MIN_CONTRAST:
+        return "too_bright"
+    return None
+
+def prepare_image(image_bytes: bytes) -> bytes:
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # Image.open only parses the header, so this check decodes no pixels
+        if img.format == "JPEG" and max(img.size) <= IMAGE_MAX_SIDE:
+            return image_bytes
+        img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.convert("RGB").save(buf, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+# ----------------------------
+# Extraction cache
+# ----------------------------
+EXTRACTION_KEYS = ("date", "supplier", "net_total", "vat_amount", "sub_category", "items")
+
+def is_valid_extraction(data: Any) -> bool:
+    if not isinstance(data, dict):
+        return False
+    if any(k not in data for k in EXTRACTION_KEYS):
+        return False
+    return isinstance(data["items"], list)
+
+def extraction_cache_key(pages: List[bytes]) -> bytes:
+    h = hashlib.sha256()
+    for image_bytes in pages:
+        h.update(len(image_bytes).to_bytes(8, "little"))
+        h.update(image_bytes)
+    image_settings = f"{OPENAI_IMAGE_DETAIL}:{IMAGE_MAX_SIDE}:{IMAGE_JPEG_QUALITY}"
+    for part in (OPENAI_MODEL, PROMPT_VERSION, SCHEMA_VERSION, image_settings):
+        h.update(b"\0")
+        h.update(part.encode("utf-8"))
+    return h.digest()
+
+# Exact-match cache of raw model output keyed by image content + prompt.
+# A small in-memory LRU sits in front of SQLite so hot repeats never touch disk;
+# if the database cannot be opened the cache keeps working in memory only.
+# Entries older than ttl_seconds are treated as misses and pruned on startup.
+class ExtractionCache:
+    def __init__(self, path: str, memory_size: int = 512, ttl_seconds: float = 30 * 86400):
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[bytes, Tuple[int, Dict[str, Any]]]" = OrderedDict()
+        self._memory_size = memory_size
+        self._ttl = ttl_seconds
+        self._db: Optional[sqlite3.Connection] = None
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            db = sqlite3.connect(path, check_same_thread=False)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS extractions ("
+                "key BLOB PRIMARY KEY, json TEXT NOT NULL, created_at INTEGER NOT NULL)"
+            )
+            db.execute("DELETE FROM extractions WHERE created_at < ?", (time.time() - self._ttl,))
+            db.commit()
+            self._db = db
+        except (OSError, sqlite3.Error):
+            logger.warning("LLM cache at %s unavailable, using memory only", path, exc_info=True)
+
+    def _expired(self, created_at: int) -> bool:
+        return created_at < time.time() - self._ttl
+
+    def _remember(self, key: bytes, created_at: int, data: Dict[str, Any]) -> None:
+        self._memory[key] = (created_at, data)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: bytes) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+            if self._db is None:
+                return None
+
+            try:
+                row = self._db.execute(
+                    "SELECT json, created_at FROM extractions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                try:
+                    data = json.loads(row[0])
+                except ValueError:
+                    data = None
+                if self._expired(row[1]) or not is_valid_extraction(data):
+                    # stale or corrupt entry: evict so the next call re-extracts
+                    self._db.execute("DELETE FROM extractions WHERE key = ?", (key,))
+                    self._db.commit()
+                    return None
+            except sqlite3.Error:
+                # a failing disk tier degrades to a miss, never to a failed invoice
+                logger.warning("LLM cache read failed, treating as miss", exc_info=True)
+                return None
+
+            self._remember(key, row[1], data)
+            return data
+
+    def set(self, key: bytes, data: Dict[str, Any]) -> None:
+        now = int(time.time())
+        with self._lock:
+            self._remember(key, now, data)
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO extractions (key, json, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(data, ensure_ascii=False), now),
+                )
+                self._db.commit()
+            except sqlite3.Error:
+                # the entry is still in the memory tier; don't lose a paid extraction over it
+                logger.warning("LLM cache write failed, kept in memory only", exc_info=True)
+
+extraction_cache = ExtractionCache(
+    LLM_CACHE_PATH,
+    memory_size=LLM_CACHE_MEMORY_SIZE,
+    ttl_seconds=LLM_CACHE_TTL_DAYS * 86400,
+)
 
-Rules:
-- date: invoice date. If missing, empty.
+# ----------------------------
+# AI Extraction
+# ----------------------------
+# Static instructions, sent as the system-level `instructions` so they always lead the
+# request and stay byte-identical between calls (cacheable prefix); bump PROMPT_VERSION on edits.
+EXTRACTION_PROMPT = """Extract structured data from this TAX INVOICE image.
+- date: invoice date as printed; empty if missing.
 - supplier: seller/company name.
 - net_total: final payable amount (grand/net total).
-- vat_amount: total VAT for invoice.
-  - If VAT not present OR shown as 0.000 => return null.
-- sub_category must be one of:
-  Gas, Grocery, Restaurant, Office Supplies, Utilities, Transport, Maintenance, Other
-  If uncertain => "Other"
-- items: extract each line from table if visible.
-  - qty, rate, discount, vat per line
-  - line_total = amount/total shown for that item row (if visible)
-  - If cannot see items => []
-Return JSON only.
+- vat_amount: total VAT for the invoice; null if absent or shown as 0.000.
+- sub_category: closest category; "Other" if uncertain.
+- items: one entry per visible table row; line_total is that row's amount. [] if unreadable.
 """
 
-    resp = client.responses.create(
-        model=OPENAI_MODEL,
-        input=[
-            {
-                "role": "user",
-                "content": [
-                    {"type": "input_text", "text": prompt},
-                    {"type": "input_image", "image_url": f"data:image/jpeg;base64,{b64}"},
-                ],
-            }
-        ],
-        temperature=0,
-    )
+# Enforced server-side (Structured Outputs), so the response text is always
+# parseable JSON of this shape. Bump SCHEMA_VERSION on edits.
+_ITEM_FIELDS = ("name", "qty", "rate", "discount", "vat", "line_total")
+INVOICE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "properties": {
+        "date": {"type": "string"},
+        "supplier": {"type": "string"},
+        "net_total": {"type": "string"},
+        "vat_amount": {"type": ["string", "null"]},
+        "sub_category": {"type": "string", "enum": list(SUB_CATEGORIES)},
+        "items": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {f: {"type": "string"} for f in _ITEM_FIELDS},
+                "required": list(_ITEM_FIELDS),
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": list(EXTRACTION_KEYS),
+    "additionalProperties": False,
+}
+
+INVOICE_TEXT_FORMAT = {
+    "format": {
+        "type": "json_schema",
+        "name": "invoice_extraction",
+        "schema": INVOICE_SCHEMA,
+        "strict": True,
+    }
+}
+
+async def request_extraction(pages: List[bytes]) -> Dict[str, Any]:
+    prepared = await asyncio.gather(*(asyncio.to_thread(prepare_image, p) for p in pages))
+    # build the data URLs as bytes and decode once; base64 output is pure ASCII
+    image_blocks = [
+        {
+            "type": "input_image",
+            "image_url": (b"data:image/jpeg;base64," + base64.b64encode(p)).decode("ascii"),
+            "detail": OPENAI_IMAGE_DETAIL,
+        }
+        for p in prepared
+    ]
+
+    content: List[Dict[str, Any]] = []
+    if len(image_blocks) > 1:
+        content.append({"type": "input_text", "text": f"These {len(image_blocks)} photos are pages of one invoice."})
+    content.extend(image_blocks)
+
+    data = await request_valid_json(content)
+    if not data["items"] and OPENAI_IMAGE_DETAIL == "low":
+        # an empty item table at low detail usually means the print was too small to read
+        logger.info("No items read at low detail, retrying with high detail")
+        for block in image_blocks:
+            block["detail"] = "high"
+        data = await request_valid_json(content)
+    return data
+
+async def request_valid_json(content: List[Dict[str, Any]]) -> Dict[str, Any]:
+    messages: List[Dict[str, Any]] = [
+        {
+            "role": "user",
+            "content": content,
+        }
+    ]
 
-    raw = resp.output_text or ""
-    data = json.loads(clean_json_only(raw))
+    error = ""
+    for attempt in range(EXTRACTION_MAX_RETRIES + 1):
+        if attempt:
+            # retry with the failure fed back to the model
+            logger.warning("Extraction attempt %d rejected: %s", attempt, error)
+            messages.append({"role": "user", "content": f"{error} Return only JSON matching the schema."})
+            await asyncio.sleep(1.0 * attempt)
+
+        async with openai_slots:
+            resp = await client.responses.create(
+                model=OPENAI_MODEL,
+                instructions=EXTRACTION_PROMPT,
+                input=messages,
+                text=INVOICE_TEXT_FORMAT,
+                temperature=0,
+            )
 
+        raw = resp.output_text or ""
+        try:
+            data = json.loads(raw)
+        except ValueError as e:
+            error = f"Response was not valid JSON ({e})."
+        else:
+            if is_valid_extraction(data):
+                return data
+            error = "Response did not match the invoice schema."
+        if raw:
+            messages.append({"role": "assistant", "content": raw})
+
+    raise ValueError(f"Model did not return valid JSON. {error}")
+
+async def extract_with_ai(pages: List[bytes]) -> Dict[str, Any]:
+    key = extraction_cache_key(pages)
+    data = await asyncio.to_thread(extraction_cache.get, key)
+    if data is None:
+        data = await request_extraction(pages)
+        await asyncio.to_thread(extraction_cache.set, key, data)
+    else:
+        logger.info("Extraction cache hit")
+    return normalize_extraction(data)
+
+def normalize_extraction(data: Dict[str, Any]) -> Dict[str, Any]:
     date_val = normalize_date_yyyy_mm_dd_slash(data.get("date"))
     supplier_val = safe_str(data.get("supplier"))
     net_total_val = safe_str(data.get("net_total"))
 
-    subcat_val = safe_str(data.get("sub_category")) or "Other"
-    allowed = {"Gas", "Grocery", "Restaurant", "Office Supplies", "Utilities", "Transport", "Maintenance", "Other"}
-    if subcat_val not in allowed:
+    subcat_val = safe_str(data.get("sub_category"))
+    if subcat_val not in _ALLOWED_SUBCAT:
         subcat_val = "Other"
 
     vat_flag = vat_yes_no(data.get("vat_amount"))
@@ -216,8 +559,9 @@ Return JSON only.
     if not isinstance(items, list):
         items = []
 
-    # Build items text for Sheet1
+    # One pass over the items builds both the Sheet1 text and the Sheet2 rows
     lines: List[str] = []
+    detail_items: List[List[Any]] = []
     for it in items:
         if not isinstance(it, dict):
             continue
@@ -244,6 +588,23 @@ Return JSON only.
             parts.append(f"line {lt}")
         lines.append(" | ".join(parts))
 
+        if not name:
+            continue
+
+        qty_f = to_number(qty) or 0.0
+        rate_f = to_number(rate) or 0.0
+        disc_f = to_number(disc) or 0.0
+
+        # Fix VAT per item
+        vat_f = 0.0 if invoice_vat_no else (to_number(vat_i) or 0.0)
+
+        # Prefer AI line_total
+        lt_f = to_number(lt)
+        if lt_f is None:
+            lt_f = (qty_f * rate_f) - disc_f + vat_f
+
+        detail_items.append([name, qty_f, rate_f, disc_f, vat_f, lt_f])
+
     items_text = "\n".join(lines).strip()
     if not items_text:
         items_text = "UNREADABLE_ITEMS"
@@ -257,123 +618,198 @@ Return JSON only.
         "sub_category": subcat_val,
         "items": items,
         "items_text": items_text,
+        "detail_items": detail_items,
     }
 
+# ----------------------------
+# Sheets Writing
+# ----------------------------
+def build_sheet_rows(result: Dict[str, Any], paid_by: str) -> Tuple[List[List[Any]], List[List[Any]]]:
+    # Sheet1 columns:
+    # date, supplier, net_total, vat, sub_category, items, paid by
+    invoice_row = [
+        result["date"],
+        result["supplier"],
+        result["net_total"],
+        result["vat_flag"],
+        result["sub_category"],
+        result.get("items_text", ""),
+        paid_by,
+    ]
+
+    # Sheet2 columns:
+    # date, supplier, product description, quantity, rate, discount, vat, total price, paid by
+    rows: List[List[Any]] = [
+        [result["date"], result["supplier"], *item, paid_by]
+        for item in result["detail_items"]
+    ]
+
+    if not rows:
+        rows.append(
+            [
+                result["date"],
+                result["supplier"],
+                "UNREADABLE_ITEMS",
+                "",
+                "",
+                "",
+                0,
+                "",
+                paid_by,
+            ]
+        )
+
+    return [invoice_row], rows
+
+# Single writer that coalesces concurrent invoices: whatever queues up while one
+# append is in flight goes out together in the next call per tab. Each caller
+# still waits for its own rows to land, so replies only confirm written data.
+class SheetsBatchWriter:
+    def __init__(self, window: float = 0.0):
+        self._window = window
+        self._queue: "asyncio.Queue[Tuple[List[List[Any]], List[List[Any]], asyncio.Future]]" = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    async def write(self, invoice_rows: List[List[Any]], item_rows: List[List[Any]]) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        done = asyncio.get_running_loop().create_future()
+        await self._queue.put((invoice_rows, item_rows, done))
+        await done
+
+    async def _run(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            if self._window:
+                await asyncio.sleep(self._window)
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            invoice_rows = [row for b in batch for row in b[0]]
+            item_rows = [row for b in batch for row in b[1]]
+            try:
+                # values:append has no multi-range form, so the two tabs are two
+                # calls, sent concurrently: one round-trip of wall time
+                await asyncio.gather(
+                    run_sheets_call(append_to_sheet, SHEET1_NAME, invoice_rows),
+                    run_sheets_call(append_to_sheet, SHEET2_NAME, item_rows),
+                )
+            except Exception as e:
+                for _, _, done in batch:
+                    if not done.done():
+                        done.set_exception(e)
+            else:
+                if len(batch) > 1:
+                    logger.info("Wrote %d invoices in one Sheets batch", len(batch))
+                for _, _, done in batch:
+                    if not done.done():
+                        done.set_result(None)
+
+sheets_writer = SheetsBatchWriter(SHEETS_BATCH_WINDOW)
+
+async def write_to_sheets(result: Dict[str, Any], paid_by: str) -> None:
+    invoice_rows, item_rows = build_sheet_rows(result, paid_by)
+    await sheets_writer.write(invoice_rows, item_rows)
+
 # ----------------------------
 # Telegram Handler
 # ----------------------------
+# Telegram redelivers an update it thinks was not acknowledged in time;
+# remember recent ids so a retry never books the same invoice twice.
+SEEN_UPDATES_SIZE = 1024
+_seen_updates: "OrderedDict[int, None]" = OrderedDict()
+
+def already_seen(update_id: int) -> bool:
+    if update_id in _seen_updates:
+        return True
+    _seen_updates[update_id] = None
+    if len(_seen_updates) > SEEN_UPDATES_SIZE:
+        _seen_updates.popitem(last=False)
+    return False
+
+# Album photos arrive as separate updates sharing a media_group_id. The first
+# one waits until the album stops growing and then handles every page; the
+# others only add themselves to the pending list.
+_media_groups: Dict[str, List[Message]] = {}
+
+def join_media_group(msg: Message) -> bool:
+    # no await between lookup and append, so exactly one page becomes the leader
+    group = _media_groups.setdefault(msg.media_group_id, [])
+    group.append(msg)
+    return len(group) == 1
+
+async def collect_media_group(media_group_id: str) -> List[Message]:
+    group = _media_groups[media_group_id]
+    try:
+        seen = 0
+        while len(group) != seen:
+            seen = len(group)
+            await asyncio.sleep(MEDIA_GROUP_WINDOW)
+    finally:
+        if _media_groups.get(media_group_id) is group:
+            del _media_groups[media_group_id]
+    return sorted(group, key=lambda m: m.message_id)
+
+async def send_typing(msg: Message) -> None:
+    # cosmetic only; a failure here must not cost the invoice
+    try:
+        await msg.chat.send_action(ChatAction.TYPING)
+    except Exception:
+        logger.warning("Could not send typing action", exc_info=True)
+
+async def download_photo(bot, message: Message) -> bytearray:
+    file = await bot.get_file(message.photo[-1].file_id)
+    return await file.download_as_bytearray()
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg or not msg.photo:
         return
+    if already_seen(update.update_id):
+        logger.info("Ignoring redelivered update %s", update.update_id)
+        return
 
     try:
-        await msg.chat.send_action(ChatAction.TYPING)
+        photo_msgs = [msg]
+        pending = []
+        if msg.media_group_id and MEDIA_GROUP_WINDOW > 0:
+            if not join_media_group(msg):
+                return
+            # keep the chat showing activity while the rest of the album arrives
+            await send_typing(msg)
+            photo_msgs = await collect_media_group(msg.media_group_id)
+        else:
+            # the typing indicator goes out alongside instead of ahead of the downloads
+            pending.append(send_typing(msg))
 
         # paid by (sender name)
         user = update.effective_user
         paid_by = user.full_name if (user and user.full_name) else (user.username if user and user.username else "Unknown")
 
-        # get image bytes
-        photo = msg.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        image_bytes = await file.download_as_bytearray()
-
-        result = extract_with_ai(bytes(image_bytes))
-
-        sh = get_spreadsheet()
-        ws1 = get_ws(sh, SHEET1_NAME)
-        ws2 = get_ws(sh, SHEET2_NAME)
-
-        # Sheet1 columns:
-        # date, supplier, net_total, vat, sub_category, items, paid by
-        ws1.append_row(
-            [
-                result["date"],
-                result["supplier"],
-                result["net_total"],
-                result["vat_flag"],
-                result["sub_category"],
-                result.get("items_text", ""),
-                paid_by,
-            ],
-            value_input_option="USER_ENTERED",
+        # get image bytes (kept as the downloaded bytearrays, no extra copy)
+        pending.extend(download_photo(context.bot, m) for m in photo_msgs)
+        results = await asyncio.gather(*pending)
+        pages = results[-len(photo_msgs):]
+
+        problems = await asyncio.gather(*(asyncio.to_thread(image_quality_problem, p) for p in pages))
+        rejected = [i for i, p in enumerate(problems, 1) if p]
+        if rejected:
+            logger.info("Photo rejected before extraction: %s", [problems[i - 1] for i in rejected])
+            if len(pages) == 1:
+                await msg.reply_text("تصویر واضح نیست، لطفاً دوباره ارسال کنید")
+            else:
+                # the album is one invoice, so name the unreadable pages instead of a generic error
+                page_list = "، ".join(str(i) for i in rejected)
+                await msg.reply_text(f"صفحه {page_list} واضح نیست، لطفاً آلبوم را دوباره ارسال کنید")
+            return
+
+        # resolve the worksheet handles while the model is busy
+        result, _ = await asyncio.gather(
+            extract_with_ai(pages),
+            run_sheets_call(prefetch_sheets),
         )
 
-        # Sheet2 columns:
-        # date, supplier, product description, quantity, rate, discount, vat, total price, paid by
-        items: List[Dict[str, Any]] = result["items"]
-
-        if items:
-            wrote_any = False
-            for item in items:
-                if not isinstance(item, dict):
-                    continue
-
-                name = safe_str(item.get("name"))
-                if not name:
-                    continue
-
-                qty = to_number(item.get("qty")) or 0.0
-                rate = to_number(item.get("rate")) or 0.0
-                discount = to_number(item.get("discount")) or 0.0
-
-                # Fix VAT per item
-                vat_i = 0.0 if result["invoice_vat_no"] else (to_number(item.get("vat")) or 0.0)
-
-                # Prefer AI line_total
-                lt = to_number(item.get("line_total"))
-                if lt is not None:
-                    total_price = lt
-                else:
-                    total_price = (qty * rate) - discount + vat_i
-
-                ws2.append_row(
-                    [
-                        result["date"],
-                        result["supplier"],
-                        name,
-                        qty,
-                        rate,
-                        discount,
-                        vat_i,
-                        total_price,
-                        paid_by,
-                    ],
-                    value_input_option="USER_ENTERED",
-                )
-                wrote_any = True
-
-            if not wrote_any:
-                ws2.append_row(
-                    [
-                        result["date"],
-                        result["supplier"],
-                        "UNREADABLE_ITEMS",
-                        "",
-                        "",
-                        "",
-                        0,
-                        "",
-                        paid_by,
-                    ],
-                    value_input_option="USER_ENTERED",
-                )
-        else:
-            ws2.append_row(
-                [
-                    result["date"],
-                    result["supplier"],
-                    "UNREADABLE_ITEMS",
-                    "",
-                    "",
-                    "",
-                    0,
-                    "",
-                    paid_by,
-                ],
-                value_input_option="USER_ENTERED",
-            )
+        await write_to_sheets(result, paid_by)
 
         await msg.reply_text("با موفقیت ثبت شد")
 
@@ -385,10 +821,33 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Main
 # ----------------------------
 def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    # handlers only await I/O or worker threads, so let PTB run updates concurrently;
+    # outgoing replies are throttled below Telegram's 30 msg/s and retried on flood wait
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(True)
+        .rate_limiter(AIORateLimiter(overall_max_rate=25, max_retries=2))
+        .build()
+    )
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    # only photos are handled, so don't have Telegram deliver edits, channel posts, etc.
+    allowed_updates = [Update.MESSAGE]
     logger.info("Bot running...")
-    app.run_polling(drop_pending_updates=True)
+    if WEBHOOK_URL:
+        # secret_token (required at startup) makes PTB reject deliveries without the matching header
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=allowed_updates,
+            drop_pending_updates=True,
+        )
+    else:
+        app.run_polling(allowed_updates=allowed_updates, drop_pending_updates=True)
 
 if __name__ == "__main__":
     main()